@@ -12,9 +12,48 @@ INVERSE_KEY_PATH = 'data/ik.txt'
 # The bit length of the secret key components p and q
 N = 128
 
+# The file path of the encrypted database written by the external-memory setup
+EDB_PATH = 'data/edb.bin'
+
+# The file path of the encrypted index written by the external-memory setup
+EIDX_PATH = 'data/eidx.txt'
+
+# The memory budget in bytes of the (keyword, doc_id) runs buffered by the external-memory setup
+MEMORY_BUDGET = 64 * 1024 * 1024
+
+# The maximum number of runs merged at once by the external-memory setup
+MERGE_FAN_IN = 64
+
+# The number of lines of the encrypted index file between two keywords kept in memory to seek it
+INDEX_SPARSE_INTERVAL = 64
+
+# The directory of the IPPE secret key files, named by key fingerprint and readable by the owner only
+KEY_DIR = 'data/keys'
+
+# The file path of the checkpoint of an ongoing key rotation
+ROTATION_CHECKPOINT_PATH = 'data/rotation.json'
+
+# The file path of the journal of the batch being applied by a key rotation
+ROTATION_JOURNAL_PATH = 'data/rotation.journal'
+
+# The number of records re-encrypted per checkpointed batch of a key rotation
+ROTATION_BATCH_SIZE = 1000
+
+# The number of worker processes re-encrypting the records of a key rotation
+ROTATION_WORKERS = 4
+
 # The security parameter lambda
 LAMBDA = 128
 
+# The number of buckets of the hashed keyword vectors (None for one bit per keyword)
+HASH_BUCKETS = None
+
+# The number of hash functions mapping each keyword into the buckets
+HASH_FUNCTIONS = 3
+
+# The number of buckets of the hashed keyword vectors when streaming the documents without a given number
+STREAM_BUCKETS = 256
+
 # The logger object for logging messages
 logger = logging.getLogger('OSSE')
 logger.setLevel(logging.INFO)
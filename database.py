@@ -2,6 +2,7 @@ import os
 import math
 import random
 import secrets
+import hashlib
 import bitstring
 
 from config import *
@@ -12,19 +13,35 @@ class Database:
     A class to represent a database of documents and keywords.
     """
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, buckets=HASH_BUCKETS, hashes=HASH_FUNCTIONS, stream=False):
         """
         Initialize the database class with the documents and the keywords.
 
         Args:
             db_path (str): the file path of the database.
+            buckets (int): the number of buckets of the hashed keyword vectors. If None, use one bit per keyword.
+            hashes (int): the number of hash functions mapping each keyword into the buckets.
+            stream (bool): whether to read the documents from the file on demand instead of loading them.
         """
-        # Load the documents from the file
-        self.docs = self.load_docs(db_path)
-        # Get the unique keywords from the documents
-        self.keywords = self.get_keywords()
-        # Get the bit length of the keywords
-        self.n = len(self.keywords)
+        # Check if the number of buckets and hash functions are positive in hashed mode
+        if buckets is not None and buckets <= 0:
+            raise ValueError(f'Invalid number of buckets: {buckets}')
+        if buckets is not None and hashes <= 0:
+            raise ValueError(f'Invalid number of hash functions: {hashes}')
+        # Check if the streamed documents use hashed keyword vectors, so no vocabulary is held in memory
+        if stream and buckets is None:
+            raise ValueError('Streaming the documents needs hashed keyword vectors')
+        # Get the file path of the database
+        self.db_path = db_path
+        # Load the documents from the file, unless they are streamed on demand
+        self.docs = None if stream else self.load_docs(db_path)
+        # Get the unique keywords from the documents, which the hashed mode does not need when streaming
+        self.keywords = [] if stream else self.get_keywords()
+        # Get the number of buckets and hash functions of the hashed keyword vectors
+        self.buckets = buckets
+        self.hashes = hashes
+        # Get the bit length of the vectors, fixed to the number of buckets in hashed mode
+        self.n = buckets if buckets else len(self.keywords)
         # Get a mapping from keywords to indices
         self.w2i = {w: i for i, w in enumerate(self.keywords)}
 
@@ -62,6 +79,28 @@ class Database:
         # Return the list of documents
         return docs
 
+    def iter_docs(self):
+        """
+        Iterate over the documents, reading them from the file if they are not loaded.
+
+        Yields:
+            list: a list of keywords representing each document.
+        """
+        # If the documents are loaded, iterate over them
+        if self.docs is not None:
+            yield from self.docs
+            return
+        # If the file does not exist
+        if not os.path.exists(self.db_path):
+            # Log the error message of file not found
+            logger.error(f'Database file not found: {self.db_path}')
+            # Exit the program
+            exit(1)
+        # Open the file in read mode and yield one document per line
+        with open(self.db_path, 'r') as f:
+            for line in f:
+                yield line.strip().split()
+
     def get_keywords(self):
         """
         Get the unique keywords from the documents.
@@ -76,7 +115,7 @@ class Database:
         # Initialize an empty set of keywords
         keywords = set()
         # For each document in the database
-        for doc in self.docs:
+        for doc in self.iter_docs():
             # Add all the keywords in the document to the set
             keywords.update(doc)
         # Convert the set to a sorted list
@@ -90,6 +129,40 @@ class Database:
         # Return the list of keywords
         return keywords
 
+    def keyword_to_buckets(self, w):
+        """
+        Map a keyword to its buckets using multiple hash functions.
+
+        Args:
+            w (str): a keyword.
+
+        Returns:
+            list: a list of bucket indices in [0, buckets).
+        """
+        # For each hash function j, hash the keyword salted with j and reduce it modulo the number of buckets
+        return [int.from_bytes(hashlib.sha256(f'{j}:{w}'.encode()).digest()[:8], 'big') % self.buckets
+                for j in range(self.hashes)]
+
+    def keywords_to_hashed_vector(self, ws):
+        """
+        Convert a list of keywords to a hashed bit vector.
+
+        Args:
+            ws (list): a list of keywords.
+
+        Returns:
+            bitstring.BitArray: a bit vector of length buckets.
+        """
+        # Initialize an all-zero bit vector x of length buckets
+        x = bitstring.BitArray(uint=0, length=self.buckets)
+        # For each keyword in the list
+        for w in ws:
+            # Set the bits of all the buckets of the keyword to 1
+            for b in self.keyword_to_buckets(w):
+                x[b] = 1
+        # Return x as the bit vector
+        return x
+
     def doc_to_vector(self, doc):
         """
         Convert a document to a bit vector.
@@ -100,6 +173,9 @@ class Database:
         Returns:
         bitstring.BitArray: a bit vector of length n. 
         """
+        # In hashed mode, return the hashed bit vector of the document
+        if self.buckets:
+            return self.keywords_to_hashed_vector(doc)
         # Initialize an empty bit vector x
         x = bitstring.BitArray()
         # For each keyword in the keyword list
@@ -120,6 +196,9 @@ class Database:
     Returns:
     bitstring.BitArray: a bit vector of length n. 
     """
+        # In hashed mode, return the hashed bit vector of the query
+        if self.buckets:
+            return self.keywords_to_hashed_vector(q)
     # Initialize an empty bit vector x
         x = bitstring.BitArray()
         # For each keyword in the keyword list
@@ -136,8 +215,15 @@ class Database:
         Returns:
         list: a list of keywords representing a query.
         """
-        # Choose a random document from the database
-        doc = random.choice(self.docs)
+        # If the documents are loaded, choose a random document from the database
+        if self.docs is not None:
+            doc = random.choice(self.docs)
+        # Otherwise, choose a random document from the stream with reservoir sampling
+        else:
+            doc = None
+            for i, d in enumerate(self.iter_docs()):
+                if random.randrange(i + 1) == 0:
+                    doc = d
         # Choose a random number k between 1 and len(doc)
         k = random.randint(1, len(doc))
         # Choose k random keywords from doc as the query
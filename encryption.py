@@ -2,8 +2,11 @@ import os
 import math
 import random
 import secrets
+import json
 import hashlib
 import bitstring
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from Crypto.Cipher import AES
 from Crypto.Util import Counter
 
@@ -15,22 +18,36 @@ class Encryption:
     A class to implement Inner Product Predicate Encryption (IPPE) scheme.
     """
 
-    def __init__(self):
+    def __init__(self, sk=None, n=None):
         """
         Initialize the encryption class with the secret key and the public parameters.
+
+        Args:
+            sk (dict): an existing secret key with components p and q, and the bit length n of the vectors
+                it was saved with. If None, generate a new one.
+            n (int): the bit length of the vectors. If None, use the one saved with the key or the bit length of p.
         """
-        # Generate the secret key p and q
-        self.sk = self.keygen()
+        # Use the given secret key or generate the secret key p and q
+        sk = sk if sk is not None else self.keygen()
         # Get the public parameter p
-        self.p = self.sk['p']
+        self.p = sk['p']
         # Get the public parameter q
-        self.q = self.sk['q']
-        # Get the bit length of p
-        self.n = math.ceil(math.log2(self.p))
+        self.q = sk['q']
+        # Check if the vectors have the bit length the key was saved with
+        if n is not None and sk.get('n', n) != n:
+            raise ValueError(f'The secret key was saved for vectors of {sk["n"]} bits, got {n}')
+        # Get the bit length of the vectors
+        self.n = n or sk.get('n') or math.ceil(math.log2(self.p))
         # Get the bit length of q
         self.m = math.ceil(math.log2(self.q))
-        # Get the security parameter lambda
+        # Get the security parameter lambda in bytes
         self.l = LAMBDA // 8
+        # Get the bit length of the ciphertexts
+        self.length = self.m * self.n + 8 * self.l
+        # Keep the bit length of the vectors with the secret key, so a saved key can be reused
+        self.sk = {'p': self.p, 'q': self.q, 'n': self.n}
+        # Get the fingerprint identifying the secret key without revealing it
+        self.fingerprint = hashlib.sha256(f'{self.p}:{self.q}'.encode()).hexdigest()[:16]
 
     def keygen(self):
         """
@@ -61,115 +78,204 @@ class Encryption:
         # Return the secret key as a dictionary with p and q as keys
         return {'p': p, 'q': q}
 
-def encrypt(self, x):
-    """
-    Encrypt a bit vector x using IPPE scheme.
+    def decrypt_many(self, cs, workers=None):
+        """
+        Decrypt a batch of ciphertexts using IPPE scheme with batched keystream generation.
 
-    Args:
-        x (bitstring.BitArray): a bit vector of length n.
+        F(k, i) encrypts the n-bit index i, zero-padded to m bits, from the same counter block for every i, so
+        its keystream only depends on k. It is generated with a single AES setup per ciphertext instead of one
+        per bit.
 
-    Returns:
-        bitstring.BitArray: a ciphertext of length m * n + l.
-    """
-    # Check if the input length is equal to n
-    assert len(x) == self.n, 'Invalid input length'
-    # Generate a random number r between 0 and q - 1
-    r = secrets.randbelow(self.q)
-    # Initialize an empty bit array y
-    y = bitstring.BitArray()
-    # For each bit in x
-    for i in range(self.n):
-        # Append (r * x[i] + a random number between 0 and p - 1) modulo q to y
-        y.append((r * x[i] + secrets.randbelow(self.p)) % self.q)
-    # Generate a random l-byte string k
-    k = bitstring.BitArray(os.urandom(self.l))
-    # Compute c as y XOR F(k, x), where F is a pseudorandom function
-    c = y ^ self.F(k, x)
-    # Append k to c
-    c.append(k)
-    # Return c as the ciphertext
-    return c
-
-def decrypt(self, c):
-    """
-    Decrypt a ciphertext c using IPPE scheme.
+        Args:
+            cs (list): a list of ciphertexts of length m * n + 8 * l.
+            workers (int): the number of worker processes. If None, decrypt in the calling process.
 
-    Args:
-        c (bitstring.BitArray): a ciphertext of length m * n + l.
+        Returns:
+            bitstring.BitArray: a packed bit matrix of len(cs) rows of n bits, where row j is the plaintext of cs[j].
+        """
+        # Get the first m bits of each n-bit index zero-padded like the input of F, once for the whole batch
+        size = (max(self.n, self.m) + 7) // 8
+        indices = [bitstring.BitArray(bitstring.BitArray(uint=i, length=self.n).tobytes().ljust(size, b'\0'))[:self.m].uint
+                   for i in range(self.n)]
+        decrypt_one = functools.partial(self.decrypt_keystream, indices=indices)
+        # Decrypt the ciphertexts in parallel or in the calling process
+        if workers:
+            with ProcessPoolExecutor(workers) as pool:
+                xs = list(pool.map(decrypt_one, cs, chunksize=max(1, len(cs) // (workers * 4))))
+        else:
+            xs = [decrypt_one(c) for c in cs]
+        # Pack the plaintexts row by row into a bit matrix
+        return bitstring.BitArray().join(xs)
 
-    Returns:
-        bitstring.BitArray: a bit vector of length n.
-    """
+    def decrypt_keystream(self, c, indices):
+        """
+        Decrypt a ciphertext with a single keystream generation.
 
+        Args:
+            c (bitstring.BitArray): a ciphertext of length m * n + 8 * l.
+            indices (list): the first m bits of each zero-padded n-bit index in [0, n) as integers.
 
-    # Check if the ciphertext length is equal to m * n + l
-    assert len(c) == self.m * self.n + self.l, 'Invalid ciphertext length'
-    # Get y as the first m * n bits of c
-    y = c[:self.m * self.n]
-    # Get k as the last l bits of c
-    k = c[self.m * self.n:]
-    # Initialize an empty bit array x
-    x = bitstring.BitArray()
-    # For each m-bit segment in y
-    for i in range(self.n):
-        # Append ((y[i] XOR F(k, i)) modulo p) modulo 2 to x, where F is a pseudorandom function and i is an index in [0, n)
-        x.append((y[i * self.m : (i + 1) * self.m] ^ self.F(k, i)) % self.p % 2)
-    # Return x as the plaintext
-    return x
-
-def ip(self, c1, c2):
-    """
-    Compute the inner product of two ciphertexts c1 and c2 using IPPE scheme.
+        Returns:
+            bitstring.BitArray: a bit vector of length n.
+        """
+        # Check if the ciphertext length is equal to m * n + 8 * l
+        assert len(c) == self.length, 'Invalid ciphertext length'
+        # Get y as the first m * n bits of c
+        y = c[:self.m * self.n]
+        # Get k as the last 8 * l bits of c, that is the l-byte key
+        k = c[self.m * self.n:]
+        # Generate the first m bits of the keystream of F(k, .) with a single AES cipher in counter mode
+        aes = AES.new(k.tobytes(), AES.MODE_CTR, counter=Counter.new(128))
+        s = bitstring.BitArray(aes.encrypt(bytes((max(self.n, self.m) + 7) // 8)))[:self.m].uint
+        # Initialize an all-zero bit array x
+        x = bitstring.BitArray(uint=0, length=self.n)
+        # For each m-bit segment in y
+        for i in range(self.n):
+            # Set x[i] to ((y[i] XOR F(k, i)) modulo p) modulo 2, where F(k, i) is the index XOR the keystream
+            x[i] = (y[i * self.m : (i + 1) * self.m].uint ^ indices[i] ^ s) % self.p % 2
+        # Return x as the plaintext
+        return x
 
-    Args:
-        c1 (bitstring.BitArray): a ciphertext of length m * n + l.
-        c2 (bitstring.BitArray): a ciphertext of length m * n + l.
+    def save_key(self, key_dir=KEY_DIR):
+        """
+        Save the secret key to a file readable by the owner only, named by its fingerprint.
 
-    Returns:
-        int: the inner product of the plaintexts modulo p.
-    """
-    # Check if the ciphertext lengths are equal to m * n + l
-    assert len(c1) == len(c2) == self.m * self.n + self.l, 'Invalid ciphertext length'
-    # Get y1 as the first m * n bits of c1
-    y1 = c1[:self.m * self.n]
-    # Get k1 as the last l bits of c1
-    k1 = c1[self.m * self.n:]
-    # Get y2 as the first m * n bits of c2
-    y2 = c2[:self.m * self.n]
-    # Get k2 as the last l bits of c2
-    k2 = c2[self.m * self.n:]
-    # Compute z as y1 XOR y2
-    z = y1 ^ y2
-    # Compute s as k1 XOR k2
-    s = k1 ^ k2
-    # Initialize d as 0
-    d = 0
-
-
-    # For each m-bit segment in z
-    for i in range(self.n):
-        # Add ((z[i] XOR F(s, i)) modulo q) to d, where F is a pseudorandom function and i is an index in [0, n)
-        d += (z[i * self.m : (i + 1) * self.m] ^ self.F(s, i)) % self.q
-    # Return d modulo p as the inner product
-    return d % self.p
-
-def F(self, k, x):
+        Args:
+            key_dir (str): the directory of the key files.
+
+        Returns:
+            str: the fingerprint referencing the saved key.
+        """
+        os.makedirs(key_dir, exist_ok=True)
+        path = os.path.join(key_dir, f'{self.fingerprint}.json')
+        # Create the file with mode 0600 and restrict it in case it already existed
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.sk, f)
+        return self.fingerprint
+
+    def encrypt(self, x):
+        """
+        Encrypt a bit vector x using IPPE scheme.
+
+        Args:
+            x (bitstring.BitArray): a bit vector of length n.
+
+        Returns:
+            bitstring.BitArray: a ciphertext of length m * n + 8 * l.
+        """
+        # Check if the input length is equal to n
+        assert len(x) == self.n, 'Invalid input length'
+        # Bound the terms of each segment so that r * x[i] + e stays below both p and q
+        bound = min(self.p, self.q) // 4
+        # Generate a random odd number r below twice the bound, so that r * x[i] has the parity of x[i]
+        r = 2 * secrets.randbelow(bound) + 1
+        # Generate a random l-byte string k
+        k = bitstring.BitArray(os.urandom(self.l))
+        # Initialize an empty bit array c
+        c = bitstring.BitArray()
+        # For each bit in x
+        for i in range(self.n):
+            # Compute (r * x[i] + a random even number e below twice the bound) modulo q as an m-bit segment
+            y = int_to_bitarray((r * x[i] + 2 * secrets.randbelow(bound)) % self.q, self.m)
+            # Append y XOR F(k, i) to c, where F is a pseudorandom function and i is an index in [0, n)
+            c.append(y ^ self.F(k, i))
+        # Append k to c
+        c.append(k)
+        # Return c as the ciphertext
+        return c
+
+    def decrypt(self, c):
+        """
+        Decrypt a ciphertext c using IPPE scheme.
+
+        Args:
+            c (bitstring.BitArray): a ciphertext of length m * n + 8 * l.
+
+        Returns:
+            bitstring.BitArray: a bit vector of length n.
+        """
+        # Check if the ciphertext length is equal to m * n + 8 * l
+        assert len(c) == self.length, 'Invalid ciphertext length'
+        # Get y as the first m * n bits of c
+        y = c[:self.m * self.n]
+        # Get k as the last 8 * l bits of c
+        k = c[self.m * self.n:]
+        # Initialize an all-zero bit array x
+        x = bitstring.BitArray(uint=0, length=self.n)
+        # For each m-bit segment in y
+        for i in range(self.n):
+            # Set x[i] to ((y[i] XOR F(k, i)) modulo p) modulo 2, where F is a pseudorandom function and i is an index in [0, n)
+            x[i] = (y[i * self.m : (i + 1) * self.m] ^ self.F(k, i)).uint % self.p % 2
+        # Return x as the plaintext
+        return x
+
+    def ip(self, c1, c2):
+        """
+        Compute the inner product of two ciphertexts c1 and c2 using IPPE scheme.
+
+        Args:
+            c1 (bitstring.BitArray): a ciphertext of length m * n + 8 * l.
+            c2 (bitstring.BitArray): a ciphertext of length m * n + 8 * l.
+
+        Returns:
+            int: the inner product of the plaintexts modulo p.
+        """
+        # Check if the ciphertext lengths are equal to m * n + 8 * l
+        assert len(c1) == len(c2) == self.length, 'Invalid ciphertext length'
+        # Get y1 as the first m * n bits of c1
+        y1 = c1[:self.m * self.n]
+        # Get k1 as the last 8 * l bits of c1
+        k1 = c1[self.m * self.n:]
+        # Get y2 as the first m * n bits of c2
+        y2 = c2[:self.m * self.n]
+        # Get k2 as the last 8 * l bits of c2
+        k2 = c2[self.m * self.n:]
+        # Compute z as y1 XOR y2
+        z = y1 ^ y2
+        # Compute s as k1 XOR k2
+        s = k1 ^ k2
+        # Initialize d as 0
+        d = 0
+        # For each m-bit segment in z
+        for i in range(self.n):
+            # Add ((z[i] XOR F(s, i)) modulo q) to d, where F is a pseudorandom function and i is an index in [0, n)
+            d += (z[i * self.m : (i + 1) * self.m] ^ self.F(s, i)).uint % self.q
+        # Return d modulo p as the inner product
+        return d % self.p
+
+    def F(self, k, x):
+        """
+        A pseudorandom function F that maps a key k and an input x to an output of length m.
+
+        Args:
+            k (bitstring.BitArray): a key of length 8 * l, that is l bytes.
+            x (bitstring.BitArray or int): an input of length n or an index in [0, n).
+
+        Returns:
+           bitstring.BitArray: an output of length m.
+        """
+        # If x is an integer, convert it to a bit array of length n
+        if isinstance(x, int):
+           x = bitstring.BitArray(uint=x, length=self.n)
+        # Check if the input lengths are valid
+        assert len(k) == 8 * self.l and len(x) == self.n, 'Invalid input length'
+        # Initialize an AES cipher with k as the key and counter mode as the mode of operation
+        aes = AES.new(k.tobytes(), AES.MODE_CTR, counter=Counter.new(128))
+        # Encrypt x zero-padded to at least m bits using the AES cipher and get the first m bits as the output
+        return bitstring.BitArray(aes.encrypt(x.tobytes().ljust((self.m + 7) // 8, b'\0')))[:self.m]
+
+def load_key(fingerprint, key_dir=KEY_DIR):
     """
-    A pseudorandom function F that maps a key k and an input x to an output of length m.
+    Load a secret key saved by Encryption.save_key.
 
     Args:
-        k (bitstring.BitArray): a key of length l.
-        x (bitstring.BitArray or int): an input of length n or an index in [0, n).
+        fingerprint (str): the fingerprint referencing the key.
+        key_dir (str): the directory of the key files.
 
     Returns:
-       bitstring.BitArray: an output of length m. 
+        dict: a dictionary containing the secret key components p and q and the bit length n of the vectors.
     """
-    # If x is an integer, convert it to a bit array of length n
-    if isinstance(x, int):
-       x = bitstring.BitArray(uint=x, length=self.n)
-    # Check if the input lengths are valid
-    assert len(k) == self.l and len(x) == self.n, 'Invalid input length'
-    # Initialize an AES cipher with k as the key and counter mode as the mode of operation
-    aes = AES.new(k.bytes, AES.MODE_CTR, counter=Counter.new(128))
-    # Encrypt x using the AES cipher and get the first m bits as the output
-    return bitstring.BitArray(aes.encrypt(x.bytes))[:self.m]
+    with open(os.path.join(key_dir, f'{fingerprint}.json'), 'r') as f:
+        return json.load(f)
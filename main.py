@@ -5,7 +5,7 @@ import bitstring
 
 from config import *
 from utils import *
-from osse import OSSE
+from osse import OSSE, load_resume_key
 
 def main():
     """
@@ -16,13 +16,35 @@ def main():
     parser.add_argument('-d', '--db', type=str, default=DB_PATH, help='the file path of the database')
     parser.add_argument('-q', '--query', type=str, nargs='+', help='the query keywords')
     parser.add_argument('-t', '--test', action='store_true', help='whether to run the test mode')
+    parser.add_argument('-b', '--buckets', type=int, default=HASH_BUCKETS, help='the number of buckets of the hashed keyword vectors')
+    parser.add_argument('-k', '--hashes', type=int, default=HASH_FUNCTIONS, help='the number of hash functions per keyword')
+    parser.add_argument('-e', '--external', action='store_true', help='whether to setup with a bounded memory budget on disk')
+    parser.add_argument('-M', '--memory', type=int, default=MEMORY_BUDGET, help='the memory budget in bytes of the external setup')
+    parser.add_argument('-r', '--rotate', action='store_true', help='whether to rotate the secret key while serving the query')
+    parser.add_argument('-m', '--materialize', action='store_true', help='whether to decrypt the vectors of the results')
+    parser.add_argument('-R', '--resume', action='store_true', help='whether to resume an interrupted key rotation of the external files')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help=f'the number of worker processes (default: {ROTATION_WORKERS} for the key rotation, none to materialize)')
     args = parser.parse_args()
 
-    # Initialize the OSSE object
-    osse = OSSE(args.db)
+    # Initialize the OSSE object, with the old key of the interrupted key rotation when resuming it, so the
+    # keyword vectors have the bit length of the encrypted files
+    sk = load_resume_key() if args.resume else None
+    osse = OSSE(args.db, args.buckets, args.hashes, args.external, sk)
 
-    # Setup the OSSE scheme
-    edb, eidx = osse.setup()
+    # Resume the interrupted key rotation of the external files in the background
+    if args.resume:
+        edb, eidx, rotation = osse.resume_rotation(workers=args.workers or ROTATION_WORKERS)
+    else:
+        # Setup the OSSE scheme
+        if args.external:
+            edb, eidx = osse.setup_external(memory_budget=args.memory)
+        else:
+            edb, eidx = osse.setup()
+
+        # Rotate the secret key in the background
+        if args.rotate:
+            rotation = osse.rotate_key(edb, eidx, workers=args.workers or ROTATION_WORKERS)
 
     # Generate a query
     if args.query:
@@ -32,11 +54,29 @@ def main():
     c = osse.query(q)
 
     # Execute the query
-    res = osse.execute(edb, eidx, c)
+    res, pk = osse.execute(edb, eidx, c)
+
+    # Verify the candidates of the hashed mode against the encrypted index
+    if osse.db.buckets:
+        res = osse.verify(eidx, q, res, pk, len(edb))
 
     # Print the results
     print(f'Query: {q}')
     print(f'Results: {res}')
+    if osse.fp_rate is not None:
+        print(f'False-positive rate: {osse.fp_rate}')
+
+    # Materialize the vectors of the results, in the calling process unless workers are given
+    if args.materialize:
+        x = osse.materialize(edb, res, pk, args.workers)
+        # Print the vector of each result, row j of the matrix being the vector of res[j]
+        for j, r in enumerate(res):
+            print(f'Vector of {r}: {x[j * osse.n : (j + 1) * osse.n].bin}')
+
+    # Wait for the key rotation and print its metrics
+    if args.rotate or args.resume:
+        rotation.thread.join()
+        print(f'Key rotation: {rotation.metrics()}')
 
 if __name__ == '__main__':
     main()
@@ -83,3 +83,18 @@ Returns:
         timer.stop()
         logger.info(f'Inverse permutation key generated and saved in {timer.duration} seconds.')
         return ik
+
+    def invert_key(self, pk):
+        """
+        Compute the inverse of a permutation key in memory.
+
+        Args:
+            pk (list): a list of integers representing the permutation key.
+
+        Returns:
+            list: a list of integers representing the inverse key.
+        """
+        ik = [0] * len(pk)
+        for i, j in enumerate(pk):
+            ik[j] = i
+        return ik
@@ -2,6 +2,9 @@ import os
 import math
 import random
 import secrets
+import tempfile
+import itertools
+import threading
 import bitstring
 
 from config import *
@@ -9,23 +12,53 @@ from utils import *
 from database import Database
 from encryption import Encryption
 from obfuscation import Obfuscation
+from encryption import load_key
+from rotation import KeyRotation, load_checkpoint
+from storage import RecordFile, IndexFile, PAIR_OVERHEAD, spill_run, merge_runs
+
+def load_resume_key(checkpoint_path=ROTATION_CHECKPOINT_PATH, key_dir=KEY_DIR):
+    """
+    Load the old key of an interrupted key rotation, to initialize the OSSE object resuming it.
+
+    Args:
+        checkpoint_path (str): the file path of the checkpoint.
+        key_dir (str): the directory of the key files.
+
+    Returns:
+        dict: the secret key referenced by the checkpoint as the old key.
+    """
+    # Load the checkpoint of the interrupted rotation
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint is None:
+        raise ValueError(f'No key rotation to resume: {checkpoint_path} not found')
+    # Load the old key from its key file
+    return load_key(checkpoint['old'], key_dir)
 
 class OSSE:
     """
     A class to implement Obfuscated Searchable Symmetric Encryption (OSSE) scheme.
     """
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, buckets=HASH_BUCKETS, hashes=HASH_FUNCTIONS, stream=False, sk=None):
         """
         Initialize the OSSE class with the database, the encryption and the obfuscation objects.
 
         Args:
             db_path (str): the file path of the database.
+            buckets (int): the number of buckets of the hashed keyword vectors. If None, use one bit per keyword.
+            hashes (int): the number of hash functions mapping each keyword into the buckets.
+            stream (bool): whether to stream the documents from the file instead of loading them. Streaming
+                uses hashed keyword vectors, with STREAM_BUCKETS buckets by default.
+            sk (dict): an existing secret key, as returned by load_key. If None, generate a new one.
         """
-        # Create a database object with the given file path
-        self.db = Database(db_path)
-        # Create an encryption object with the IPPE scheme
-        self.enc = Encryption()
+        # When streaming, use hashed keyword vectors so no vocabulary is held in memory, with the bit length
+        # saved with the given key if any
+        if stream and buckets is None:
+            buckets = sk['n'] if sk is not None and 'n' in sk else STREAM_BUCKETS
+        # Create a database object with the given file path and keyword encoding
+        self.db = Database(db_path, buckets, hashes, stream)
+        # Create an encryption object with the IPPE scheme for vectors of the bit length of the database
+        self.enc = Encryption(sk, self.db.n)
         # Create an obfuscation object with the random permutation
         self.obf = Obfuscation()
         # Get the bit length of the keywords from the encryption object
@@ -34,6 +67,12 @@ class OSSE:
         self.m = self.enc.m
         # Get the security parameter lambda from the encryption object
         self.l = LAMBDA // 8
+        # The false-positive rate of the last verified query
+        self.fp_rate = None
+        # The key rotation in progress, if any
+        self.rotation = None
+        # The lock guarding the encrypted database, the index and the key in use against a key rotation
+        self.lock = threading.Lock()
 
     def setup(self):
         """
@@ -43,7 +82,7 @@ class OSSE:
 
         Returns:
         list: a list of ciphertexts representing the encrypted database.
-        dict: a dictionary mapping keywords to ciphertexts representing the encrypted index.
+        dict: a dictionary mapping keywords to lists of ciphertexts representing the encrypted index.
         """
         # Log the message of setting up OSSE scheme
         logger.info('Setting up OSSE scheme...')
@@ -65,14 +104,16 @@ class OSSE:
             for w in doc:
         # If the keyword is not in the encrypted index dictionary
                 if w not in eidx:
-        # Initialize an empty bit array for the keyword
-                    eidx[w] = bitstring.BitArray()
-        # Append the document id to the bit array of the keyword
+        # Initialize an empty posting list for the keyword
+                    eidx[w] = []
+        # Append the document id to the posting list of the keyword
                 eidx[w].append(doc_id)
+        # Get the fixed bit width of the document ids
+        width = id_width(len(edb))
         # For each keyword in the encrypted index dictionary
         for w in eidx:
-        # Encrypt the bit array of the keyword using the encryption object
-            eidx[w] = self.enc.encrypt(eidx[w])
+        # Pack the posting list of the keyword into n-bit blocks of fixed-width ids and encrypt each block
+            eidx[w] = [self.enc.encrypt(x) for x in encode_postings(eidx[w], width, self.n)]
         # Stop the timer
         timer.stop()
         # Log the message of OSSE scheme set up with the elapsed time
@@ -80,6 +121,81 @@ class OSSE:
         # Return the encrypted database list and encrypted index dictionary
         return edb, eidx
 
+    def setup_external(self, edb_path=EDB_PATH, eidx_path=EIDX_PATH, memory_budget=MEMORY_BUDGET, fan_in=MERGE_FAN_IN):
+        """
+        Setup the OSSE scheme with a bounded memory budget, writing the encrypted database and index to disk.
+
+        The (keyword, doc_id) pairs are buffered until the memory budget is reached, then sorted and spilled
+        as runs to temporary files. The runs are merged with k-way merges of bounded fan-in into posting lists,
+        which are packed into n-bit blocks of fixed-width ids, encrypted block by block and written to the index
+        file as they are merged.
+
+        Args:
+            edb_path (str): the file path of the encrypted database.
+            eidx_path (str): the file path of the encrypted index.
+            memory_budget (int): the memory budget in bytes of the buffered pairs.
+            fan_in (int): the maximum number of runs merged at once.
+
+        Returns:
+        RecordFile: the encrypted database stored on disk.
+        IndexFile: the encrypted index stored on disk.
+        """
+        # Log the message of setting up OSSE scheme
+        logger.info(f'Setting up OSSE scheme with a memory budget of {memory_budget} bytes...')
+        # Start the timer
+        timer.start()
+        # Create the encrypted database file with the ciphertext length as the record width
+        edb = RecordFile(edb_path, self.enc.length)
+        # Create a temporary directory for the runs
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Initialize an empty list of run paths, an empty buffer of pairs and its estimated size
+            runs = []
+            pairs = []
+            used = 0
+            # For each document id and document streamed from the database
+            for doc_id, doc in enumerate(self.db.iter_docs()):
+                # Convert the document to a bit vector, encrypt it and append it to the encrypted database file
+                edb.append(self.enc.encrypt(self.db.doc_to_vector(doc)))
+                # For each keyword in the document
+                for w in doc:
+                    # Buffer the pair of the keyword and the document id
+                    pairs.append((w, doc_id))
+                    used += len(w) + PAIR_OVERHEAD
+                    # If the buffer exceeds the memory budget, spill it as a sorted run
+                    if used >= memory_budget:
+                        runs.append(spill_run(pairs, tmp_dir))
+                        pairs = []
+                        used = 0
+            # Spill the remaining pairs as the last run
+            if pairs:
+                runs.append(spill_run(pairs, tmp_dir))
+            pairs = None
+            # Flush the encrypted database to disk
+            edb.flush()
+            # Get the fixed bit width of the document ids
+            width = id_width(len(edb))
+            # Get the number of document ids per n-bit block
+            slots = ids_per_block(width, self.n)
+            # Create the encrypted index file
+            eidx = IndexFile(eidx_path, 'w+')
+            # For each keyword and its posting list merged from the runs
+            for w, doc_ids in merge_runs(runs, tmp_dir, fan_in):
+                # For each chunk of one block of document ids of the posting list
+                while True:
+                    chunk = list(itertools.islice(doc_ids, slots))
+                    if not chunk:
+                        break
+                    # Encode the chunk as an n-bit block, encrypt it and write it to the encrypted index file
+                    eidx.write(w, self.enc.encrypt(encode_block(chunk, width, self.n)))
+            # Flush the encrypted index to disk
+            eidx.flush()
+        # Stop the timer
+        timer.stop()
+        # Log the message of OSSE scheme set up with the elapsed time and the number of runs
+        logger.info(f'OSSE scheme set up in {timer.duration} seconds from {len(runs)} runs.')
+        # Return the encrypted database and index files
+        return edb, eidx
+
     def query(self, q):
         """
         Generate a query for a conjunctive keyword search using OSSE scheme.
@@ -88,7 +204,7 @@ class OSSE:
         q (list): a list of keywords representing the query.
 
         Returns:
-        bitstring.BitArray: a ciphertext representing the encrypted query.
+        dict: a dictionary mapping the fingerprint of each key in use to the encrypted query under that key.
         """
         # Check if the query is not empty
         assert len(q) > 0, 'Invalid query'
@@ -99,8 +215,11 @@ class OSSE:
 
         # Convert the query to a bit vector using the database object
         x = self.db.query_to_vector(q)
-        # Encrypt the bit vector using the encryption object
-        c = self.enc.encrypt(x)
+        # Get the encryption objects of the keys in use, both generations while a key rotation is in progress
+        with self.lock:
+            encs = self.rotation.encs if self.rotation is not None else [self.enc]
+        # Encrypt the bit vector under every key in use, tagged by the fingerprint of the key
+        c = {enc.fingerprint: enc.encrypt(x) for enc in encs}
         # Stop the timer
         timer.stop()
         # Log the message of query generated with the elapsed time
@@ -114,11 +233,12 @@ class OSSE:
 
         Args:
             edb (list): a list of ciphertexts representing the encrypted database.
-            eidx (dict): a dictionary mapping keywords to ciphertexts representing the encrypted index.
-            c (bitstring.BitArray): a ciphertext representing the encrypted query.
+            eidx (dict): a dictionary mapping keywords to lists of ciphertexts representing the encrypted index.
+            c (dict): a dictionary mapping key fingerprints to the encrypted query, as returned by query.
 
         Returns:
-            list: a list of document ids representing the matching results.
+            list: a list of permuted document ids representing the matching results.
+            list: the permutation key mapping the document ids to the permuted document ids.
         """
         # Log the message of executing query on edb and eidx
         logger.info('Executing query on edb and eidx...')
@@ -126,10 +246,16 @@ class OSSE:
         timer.start()
         # Initialize an empty list of matching results
         res = []
-        # For each document id and ciphertext in edb
-        for doc_id, c1 in enumerate(edb):
-            # Compute the inner product of c and c1 using the encryption object
-            d = self.enc.ip(c, c1)
+        # For each document id in edb
+        for doc_id in range(len(edb)):
+            # Read the ciphertext with the encryption object of its key, which a key rotation may change mid-query
+            enc, c1 = self.read(edb, doc_id)
+            # Reject a query that was not encrypted under that key, for instance one generated before a key
+            # rotation started, so it must be re-issued
+            if enc.fingerprint not in c:
+                raise ValueError(f'Query is not encrypted under the key {enc.fingerprint} in use, re-issue it')
+            # Compute the inner product of the query and c1 under the key of c1
+            d = enc.ip(c[enc.fingerprint], c1)
             # If the inner product is 0
             if d == 0:
             # Append the document id to the matching results list
@@ -146,6 +272,210 @@ class OSSE:
         timer.stop()
         # Log the message of query executed with the elapsed time and the number of results
         logger.info(f'Query executed in {timer.duration} seconds. {len(res)} results found.')
-        # Return res as the matching results list
-        return res
+        # Return res as the matching results list with the permutation key
+        return res, pk
+
+    def materialize(self, edb, res, pk, workers=None):
+        """
+        Materialize the plaintext vectors of the results of a query.
+
+        Args:
+            edb (list or RecordFile): the encrypted database.
+            res (list): a list of permuted document ids returned by execute.
+            pk (list): the permutation key returned by execute with res.
+            workers (int): the number of worker processes decrypting the ciphertexts.
+
+        Returns:
+            bitstring.BitArray: a packed bit matrix of len(res) rows of n bits, where row j is the vector of res[j].
+        """
+        # Log the message of materializing results
+        logger.info(f'Materializing {len(res)} results...')
+        # Start the timer
+        timer.start()
+        # Get the inverse permutation key in memory using the obfuscation object
+        ik = self.obf.invert_key(pk)
+        # Map the permuted document ids back to the document ids
+        doc_ids = [ik[r] for r in res]
+        # Read the ciphertexts with the encryption objects of their keys
+        records = [self.read(edb, doc_id) for doc_id in doc_ids]
+        # Decrypt the ciphertexts of each key in one batch, two keys being in use during a key rotation
+        rows = [None] * len(records)
+        for fingerprint in {enc.fingerprint for enc, _ in records}:
+            js = [j for j, (enc, _) in enumerate(records) if enc.fingerprint == fingerprint]
+            enc = records[js[0]][0]
+            xs = enc.decrypt_many([records[j][1] for j in js], workers)
+            # Restore the result order of the decrypted rows
+            for t, j in enumerate(js):
+                rows[j] = xs[t * enc.n : (t + 1) * enc.n]
+        x = bitstring.BitArray().join(rows)
+        # Stop the timer
+        timer.stop()
+        # Log the message of results materialized with the elapsed time
+        logger.info(f'{len(res)} results materialized in {timer.duration} seconds.')
+        # Return x as the packed bit matrix
+        return x
+
+    def rotate_key(self, edb, eidx, batch_size=ROTATION_BATCH_SIZE, workers=ROTATION_WORKERS, background=True):
+        """
+        Rotate the secret key by re-encrypting the encrypted database and index in checkpointed batches.
+
+        Queries keep being served during the rotation, each record under the key generation it currently has.
+        If edb and eidx are files on disk, the rotation is checkpointed and resumes from the checkpoint of an
+        interrupted rotation of the same files under the same key.
+
+        Args:
+            edb (list or RecordFile): the encrypted database.
+            eidx (dict or IndexFile): the encrypted index.
+            batch_size (int): the number of records re-encrypted per checkpointed batch.
+            workers (int): the number of worker processes re-encrypting the records.
+            background (bool): whether to run the rotation in a background thread.
+
+        Returns:
+            KeyRotation: the key rotation, exposing its progress and throughput metrics.
+        """
+        # Create the key rotation from the current encryption object, sharing the lock of the readers
+        rotation = KeyRotation(self.enc, edb, eidx, batch_size, workers, lock=self.lock)
+        # Serve the queries with the key generations of the rotation
+        with self.lock:
+            self.rotation = rotation
+
+        def run():
+            # Re-encrypt the records, then switch to the new key
+            rotation.run()
+            with self.lock:
+                self.enc = rotation.new
+                self.rotation = None
+
+        # Run the rotation in a background thread or in the calling thread
+        if background:
+            rotation.thread = threading.Thread(target=run, daemon=True)
+            rotation.thread.start()
+        else:
+            run()
+        # Return the rotation
+        return rotation
 
+    def open_external(self, edb_path=EDB_PATH, eidx_path=EIDX_PATH):
+        """
+        Reopen the encrypted database and index written by the external-memory setup.
+
+        Args:
+            edb_path (str): the file path of the encrypted database.
+            eidx_path (str): the file path of the encrypted index.
+
+        Returns:
+        RecordFile: the encrypted database stored on disk.
+        IndexFile: the encrypted index stored on disk.
+        """
+        return RecordFile(edb_path), IndexFile(eidx_path, 'r+')
+
+    def resume_rotation(self, edb_path=EDB_PATH, eidx_path=EIDX_PATH, batch_size=ROTATION_BATCH_SIZE,
+                        workers=ROTATION_WORKERS, background=True):
+        """
+        Resume an interrupted key rotation of the encrypted database and index on disk.
+
+        The OSSE object must be initialized with the old key referenced by the checkpoint, as returned by
+        load_resume_key, so the keyword vectors have the bit length the key was saved with.
+
+        Args:
+            edb_path (str): the file path of the encrypted database.
+            eidx_path (str): the file path of the encrypted index.
+            batch_size (int): the number of records re-encrypted per checkpointed batch.
+            workers (int): the number of worker processes re-encrypting the records.
+            background (bool): whether to run the rotation in a background thread.
+
+        Returns:
+        RecordFile: the encrypted database stored on disk.
+        IndexFile: the encrypted index stored on disk.
+        KeyRotation: the resumed key rotation.
+        """
+        # Reopen the files and resume the rotation, which checks they belong to the checkpoint and the key
+        edb, eidx = self.open_external(edb_path, eidx_path)
+        rotation = self.rotate_key(edb, eidx, batch_size, workers, background)
+        return edb, eidx, rotation
+
+    def read(self, edb, doc_id):
+        """
+        Read a record with the encryption object of its key, consistently with a key rotation.
+
+        Args:
+            edb (list or RecordFile): the encrypted database.
+            doc_id (int): the document id of the record.
+
+        Returns:
+            Encryption: the encryption object of the key the record is encrypted under.
+            bitstring.BitArray: the ciphertext of the record.
+        """
+        # Check the key rotation and read the record under the lock, so the record and its key generation match
+        with self.lock:
+            rotation = self.rotation
+            enc = rotation.encs[rotation.generation[doc_id]] if rotation is not None else self.enc
+            return enc, edb[doc_id]
+
+    def verify(self, eidx, q, res, pk, total):
+        """
+        Verify the candidates of a hashed query on the client against the encrypted index.
+
+        The posting lists of the query keywords are decrypted from the encrypted index, so the plaintext
+        query never leaves the client.
+
+        Args:
+            eidx (dict or IndexFile): the encrypted index.
+            q (list): a list of keywords representing the query.
+            res (list): a list of permuted candidate document ids returned by execute.
+            pk (list): the permutation key returned by execute.
+            total (int): the number of documents in the encrypted database.
+
+        Returns:
+            list: the permuted document ids of the candidates containing every keyword of the query.
+        """
+        # Log the message of verifying candidates
+        logger.info(f'Verifying {len(res)} candidates...')
+        # Start the timer
+        timer.start()
+        # Get the inverse permutation key using the obfuscation object
+        ik = self.obf.invert_key(pk)
+        # Get the fixed bit width of the document ids
+        width = id_width(total)
+        # Intersect the decrypted posting lists of all the keywords in the query
+        matches = None
+        for w in q:
+            doc_ids = self.postings(eidx, w, width)
+            matches = doc_ids if matches is None else matches & doc_ids
+        # Keep the candidates whose document id is in the intersection
+        verified = [r for r in res if ik[r] in matches]
+        # Count the candidates rejected by the verification
+        fp = len(res) - len(verified)
+        # Compute the false-positive rate over the non-matching documents
+        self.fp_rate = fp / max(total - len(verified), 1)
+        # Stop the timer
+        timer.stop()
+        # Log the message of candidates verified with the number of false positives and the false-positive rate
+        logger.info(f'{len(res)} candidates verified in {timer.duration} seconds. '
+                    f'{fp} false positives, false-positive rate {self.fp_rate:.6f}.')
+        # Return the verified results list
+        return verified
+
+    def postings(self, eidx, w, width):
+        """
+        Decrypt the posting list of a keyword from the encrypted index.
+
+        Args:
+            eidx (dict or IndexFile): the encrypted index.
+            w (str): a keyword.
+            width (int): the bit width of the document ids.
+
+        Returns:
+            set: the document ids of the documents containing the keyword.
+        """
+        # Read the ciphertexts of the keyword with the encryption object of the index
+        with self.lock:
+            rotation = self.rotation
+            enc = rotation.encs[rotation.index_generation] if rotation is not None else self.enc
+            cs = eidx.get(w) or []
+        # Decrypt and decode every block of the posting list
+        doc_ids = set()
+        for c in cs:
+            doc_ids.update(decode_postings(enc.decrypt(c), width))
+        # Return the document ids
+        return doc_ids
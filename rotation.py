@@ -0,0 +1,380 @@
+import os
+import json
+import time
+import itertools
+import threading
+import bitstring
+from concurrent.futures import ProcessPoolExecutor
+
+from config import *
+from utils import *
+from encryption import Encryption, load_key
+from storage import RecordFile, IndexFile
+
+def reencrypt(old, new, c):
+    """
+    Re-encrypt a ciphertext from an old key to a new key.
+
+    Args:
+        old (Encryption): the encryption object of the old key.
+        new (Encryption): the encryption object of the new key.
+        c (bitstring.BitArray): a ciphertext under the old key.
+
+    Returns:
+        bitstring.BitArray: the ciphertext of the same plaintext under the new key.
+    """
+    return new.encrypt(old.decrypt(c))
+
+def load_checkpoint(checkpoint_path=ROTATION_CHECKPOINT_PATH):
+    """
+    Load the checkpoint of an interrupted key rotation.
+
+    Args:
+        checkpoint_path (str): the file path of the checkpoint.
+
+    Returns:
+        dict: the checkpoint, or None if there is none.
+    """
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r') as f:
+        return json.load(f)
+
+class KeyRotation:
+    """
+    A class to rotate the secret key of the encrypted database and index online in checkpointed batches.
+
+    Each record keeps the key generation it is currently encrypted under, 0 for the old key and 1 for
+    the new key, so that queries can be served while the records are re-encrypted. Only a rotation of a
+    RecordFile and an IndexFile is checkpointed and can be resumed; an in-memory rotation is not.
+
+    The index file is re-encrypted into a staged file, which is checkpointed before it is swapped in, so an
+    interrupted swap is completed on resume instead of re-encrypting entries already under the new key.
+    Once the rotation completes, its checkpoint and the key file of the retired key are deleted.
+    """
+
+    def __init__(self, enc, edb, eidx, batch_size=ROTATION_BATCH_SIZE, workers=ROTATION_WORKERS,
+                 checkpoint_path=ROTATION_CHECKPOINT_PATH, journal_path=ROTATION_JOURNAL_PATH,
+                 key_dir=KEY_DIR, new=None, lock=None):
+        """
+        Initialize the key rotation, resuming it from its checkpoint if one exists for the same store and key.
+
+        Args:
+            enc (Encryption): the encryption object of the current key.
+            edb (list or RecordFile): the encrypted database.
+            eidx (dict or IndexFile): the encrypted index, mapping keywords to lists of ciphertexts.
+            batch_size (int): the number of records re-encrypted per checkpointed batch.
+            workers (int): the number of worker processes re-encrypting the records.
+            checkpoint_path (str): the file path of the checkpoint.
+            journal_path (str): the file path of the journal of the batch being applied.
+            key_dir (str): the directory of the key files referenced by the checkpoint.
+            new (Encryption): the encryption object of the new key. If None, generate it or load it from the
+                checkpoint.
+            lock (threading.Lock): the lock shared with the readers of the records and the index. If None, create one.
+        """
+        self.edb = edb
+        self.eidx = eidx
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint_path = checkpoint_path
+        self.journal_path = journal_path
+        self.key_dir = key_dir
+        # The lock guarding the records and their generations against concurrent queries
+        self.lock = lock if lock is not None else threading.Lock()
+        # Only a rotation of files on disk is checkpointed and resumed
+        self.durable = isinstance(edb, RecordFile) and isinstance(eidx, IndexFile)
+        checkpoint = load_checkpoint(checkpoint_path) if self.durable else None
+        # If a checkpoint exists, resume the rotation after checking it belongs to this store and key
+        if checkpoint is not None:
+            if (checkpoint['edb'] != os.path.abspath(edb.path) or checkpoint['eidx'] != os.path.abspath(eidx.path)
+                    or checkpoint['old'] != enc.fingerprint):
+                raise ValueError(f'Checkpoint {checkpoint_path} belongs to {checkpoint["edb"]} under key '
+                                 f'{checkpoint["old"]}, not to {edb.path} under key {enc.fingerprint}')
+            if new is None:
+                new = Encryption(load_key(checkpoint['new'], key_dir))
+            elif new.fingerprint != checkpoint['new']:
+                raise ValueError(f'Checkpoint {checkpoint_path} rotates to key {checkpoint["new"]}, not {new.fingerprint}')
+            self.cursor = checkpoint['cursor']
+            self.index_generation = checkpoint['index_generation']
+            self.index_staged = checkpoint['index_staged']
+            logger.info(f'Resuming key rotation at record {self.cursor}...')
+        # Otherwise, start a new rotation
+        else:
+            # A journal without its checkpoint cannot be attributed to this store
+            if self.durable and os.path.exists(journal_path):
+                raise ValueError(f'Journal {journal_path} has no checkpoint')
+            # Generate a new key for vectors of the same bit length and with a q of the same bit length, so the
+            # ciphertexts keep their width
+            if new is None:
+                new = Encryption(n=enc.n)
+                while new.m != enc.m:
+                    new = Encryption(n=enc.n)
+            assert (new.n, new.m) == (enc.n, enc.m), 'Invalid new key length'
+            self.cursor = 0
+            self.index_generation = 0
+            self.index_staged = False
+            # Save both keys so the checkpoint only needs to reference them
+            if self.durable:
+                enc.save_key(key_dir)
+                new.save_key(key_dir)
+        # The encryption objects indexed by key generation
+        self.encs = [enc, new]
+        self.new = new
+        # The key generation of each record, rotated up to the cursor
+        self.generation = bytearray([1]) * self.cursor + bytearray(len(edb) - self.cursor)
+        # The number of records rotated and the start time of this run, for the metrics
+        self.rotated = 0
+        self.start_time = None
+        self.end_time = None
+        # The background thread running the rotation, if any
+        self.thread = None
+        # Apply the batch left in the journal and complete the index swap of an interrupted run, then save the
+        # checkpoint
+        if self.durable:
+            self.replay_journal()
+            if self.index_staged and not self.index_generation:
+                self.swap_index()
+            self.save_checkpoint()
+
+    @property
+    def progress(self):
+        """
+        Get the fraction of the records rotated to the new key.
+
+        Returns:
+            float: the progress in [0, 1].
+        """
+        return self.cursor / len(self.edb) if len(self.edb) else 1.0
+
+    @property
+    def throughput(self):
+        """
+        Get the number of records rotated per second in this run.
+
+        Returns:
+            float: the throughput in records per second.
+        """
+        if self.start_time is None:
+            return 0.0
+        elapsed = (self.end_time or time.time()) - self.start_time
+        return self.rotated / elapsed if elapsed > 0 else 0.0
+
+    def metrics(self):
+        """
+        Get the progress and throughput metrics of the rotation.
+
+        Returns:
+            dict: the rotated and total records, the progress, the throughput, the elapsed time and whether
+            the index is rotated.
+        """
+        return {
+            'rotated': self.cursor,
+            'total': len(self.edb),
+            'progress': self.progress,
+            'throughput': self.throughput,
+            'elapsed': ((self.end_time or time.time()) - self.start_time) if self.start_time else 0.0,
+            'index_rotated': bool(self.index_generation),
+        }
+
+    def read(self, doc_id):
+        """
+        Read a record together with the key generation it is encrypted under.
+
+        Args:
+            doc_id (int): the document id of the record.
+
+        Returns:
+            int: the key generation of the record.
+            bitstring.BitArray: the ciphertext of the record.
+        """
+        with self.lock:
+            return self.generation[doc_id], self.edb[doc_id]
+
+    def reencrypt_all(self, pool, cs):
+        """
+        Re-encrypt ciphertexts from the old key to the new key in the worker processes.
+
+        Args:
+            pool (ProcessPoolExecutor): the pool of worker processes.
+            cs (list): the ciphertexts under the old key.
+
+        Returns:
+            list: the ciphertexts under the new key.
+        """
+        chunksize = max(1, len(cs) // (self.workers * 4))
+        return list(pool.map(reencrypt, itertools.repeat(self.encs[0]), itertools.repeat(self.encs[1]), cs,
+                             chunksize=chunksize))
+
+    def run(self):
+        """
+        Re-encrypt the remaining records in batches, then the index, checkpointing after each batch.
+        """
+        # Log the message of rotating key
+        logger.info(f'Rotating key of {len(self.edb) - self.cursor} records with {self.workers} workers...')
+        # Start the metrics clock
+        self.start_time = time.time()
+        with ProcessPoolExecutor(self.workers) as pool:
+            # For each batch of records after the cursor
+            while self.cursor < len(self.edb):
+                start = self.cursor
+                end = min(start + self.batch_size, len(self.edb))
+                # Read the batch of records
+                with self.lock:
+                    batch = [self.edb[i] for i in range(start, end)]
+                # Re-encrypt the batch in parallel
+                cs = self.reencrypt_all(pool, batch)
+                # Journal the batch before applying it, so an interrupted batch can be replayed
+                if self.durable:
+                    self.write_journal(start, cs)
+                self.apply(start, cs)
+                # Advance the cursor, save the checkpoint and drop the journal
+                self.cursor = end
+                if self.durable:
+                    self.save_checkpoint()
+                    os.remove(self.journal_path)
+                self.rotated += len(cs)
+                # Log the message of batch rotated with the progress and throughput
+                logger.info(f'{self.cursor}/{len(self.edb)} records rotated '
+                            f'({self.progress:.1%}, {self.throughput:.1f} records/s).')
+            # Re-encrypt the index if it is not rotated yet
+            if not self.index_generation:
+                self.rotate_index(pool)
+        # Stop the metrics clock
+        self.end_time = time.time()
+        # Remove the checkpoint of the finished rotation, then the key file of the retired key it referenced
+        if self.durable:
+            os.remove(self.checkpoint_path)
+            retired = os.path.join(self.key_dir, f'{self.encs[0].fingerprint}.json')
+            if os.path.exists(retired):
+                os.remove(retired)
+        # Log the message of key rotated with the elapsed time
+        logger.info(f'Key rotated in {self.end_time - self.start_time} seconds.')
+
+    def rotate_index(self, pool):
+        """
+        Re-encrypt the index in parallel and swap it in atomically.
+
+        Args:
+            pool (ProcessPoolExecutor): the pool of worker processes.
+        """
+        # Re-encrypt the in-memory index and update the dictionary in place
+        if isinstance(self.eidx, dict):
+            with self.lock:
+                old_entries = [(w, c) for w, cs in self.eidx.items() for c in cs]
+            postings = {}
+            for w, c in self.reencrypt_entries(pool, iter(old_entries)):
+                postings.setdefault(w, []).append(c)
+            with self.lock:
+                self.eidx.update(postings)
+                self.index_generation = 1
+            count = len(old_entries)
+        # Otherwise, stream the re-encrypted entries of the index file to the staged index, checkpoint it and swap it in
+        else:
+            count = self.eidx.stage(self.reencrypt_entries(pool, self.eidx.scan()))
+            self.index_staged = True
+            self.save_checkpoint()
+            self.swap_index()
+            self.save_checkpoint()
+        # Log the message of index rotated with the number of entries
+        logger.info(f'{count} index entries rotated.')
+
+    def reencrypt_entries(self, pool, entries):
+        """
+        Re-encrypt index entries in batches of at most batch_size entries.
+
+        Args:
+            pool (ProcessPoolExecutor): the pool of worker processes.
+            entries (iterator): the keyword and ciphertext pairs under the old key.
+
+        Yields:
+            tuple: the keyword and ciphertext pairs under the new key, in the same order.
+        """
+        while True:
+            batch = list(itertools.islice(entries, self.batch_size))
+            if not batch:
+                break
+            cs = self.reencrypt_all(pool, [c for _, c in batch])
+            yield from zip([w for w, _ in batch], cs)
+
+    def swap_index(self):
+        """
+        Swap the staged index in and mark the index with the new key generation.
+        """
+        with self.lock:
+            self.eidx.commit()
+            self.index_generation = 1
+
+    def apply(self, start, cs):
+        """
+        Write a batch of re-encrypted records and mark them with the new key generation.
+
+        Args:
+            start (int): the document id of the first record of the batch.
+            cs (list): the ciphertexts of the batch under the new key.
+        """
+        with self.lock:
+            for i, c in enumerate(cs, start):
+                self.edb[i] = c
+                self.generation[i] = 1
+            # Flush the records if they are stored on disk
+            if self.durable:
+                self.edb.flush()
+
+    def write_journal(self, start, cs):
+        """
+        Atomically write a batch of re-encrypted records to the journal.
+
+        Args:
+            start (int): the document id of the first record of the batch.
+            cs (list): the ciphertexts of the batch under the new key.
+        """
+        records = [[len(c), c.tobytes().hex()] for c in cs]
+        self.write_json(self.journal_path, {'start': start, 'records': records})
+
+    def replay_journal(self):
+        """
+        Apply the batch left in the journal by an interrupted run, if any.
+        """
+        # If there is no journal, there is nothing to replay
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'r') as f:
+            journal = json.load(f)
+        # Decode and apply the journaled batch, which is idempotent
+        cs = [bitstring.BitArray(bytes.fromhex(data))[:length] for length, data in journal['records']]
+        self.apply(journal['start'], cs)
+        self.cursor = max(self.cursor, journal['start'] + len(cs))
+        self.save_checkpoint()
+        os.remove(self.journal_path)
+        # Log the message of journal replayed with the number of records
+        logger.info(f'{len(cs)} journaled records replayed.')
+
+    def save_checkpoint(self):
+        """
+        Atomically save the identity of the store, the references of the keys and the progress of the rotation.
+        """
+        self.write_json(self.checkpoint_path, {
+            'edb': os.path.abspath(self.edb.path),
+            'eidx': os.path.abspath(self.eidx.path),
+            'old': self.encs[0].fingerprint,
+            'new': self.encs[1].fingerprint,
+            'cursor': self.cursor,
+            'index_staged': self.index_staged,
+            'index_generation': self.index_generation,
+        })
+
+    def write_json(self, path, obj):
+        """
+        Atomically write an object as JSON to a file readable by the owner only.
+
+        Args:
+            path (str): the file path.
+            obj (dict): the object to write.
+        """
+        tmp_path = path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
@@ -0,0 +1,421 @@
+import os
+import heapq
+import bisect
+import itertools
+import tempfile
+import bitstring
+
+from config import *
+from utils import *
+
+# The estimated memory overhead in bytes of a buffered (keyword, doc_id) pair besides the keyword characters
+PAIR_OVERHEAD = 128
+
+class RecordFile:
+    """
+    A class to store fixed-width ciphertexts in a file on disk.
+    """
+
+    def __init__(self, path, width=None):
+        """
+        Initialize the record file, creating it if a width is given or opening it otherwise.
+
+        Args:
+            path (str): the file path of the records.
+            width (int): the bit length of each record. If None, read it from the existing file.
+        """
+        self.path = path
+        # If a width is given, create a new file and write the width as its header
+        if width is not None:
+            self.f = open(path, 'w+b')
+            self.f.write(width.to_bytes(8, 'big'))
+        # Otherwise, open the existing file and read the width from its header
+        else:
+            self.f = open(path, 'r+b')
+            width = int.from_bytes(self.f.read(8), 'big')
+        # Get the bit length and the byte length of each record
+        self.width = width
+        self.size = (width + 7) // 8
+        # Get the number of records from the file size
+        self.f.seek(0, os.SEEK_END)
+        self.count = (self.f.tell() - 8) // self.size if self.size else 0
+
+    def __len__(self):
+        """
+        Get the number of records.
+
+        Returns:
+            int: the number of records.
+        """
+        return self.count
+
+    def __getitem__(self, i):
+        """
+        Read the i-th record.
+
+        Args:
+            i (int): the index of the record.
+
+        Returns:
+            bitstring.BitArray: the ciphertext stored at index i.
+        """
+        # Check if the index is in range
+        if not 0 <= i < self.count:
+            raise IndexError('Record index out of range')
+        # Seek to the record and read its bytes
+        self.f.seek(8 + i * self.size)
+        return bitstring.BitArray(self.f.read(self.size))[:self.width]
+
+    def __setitem__(self, i, c):
+        """
+        Overwrite the i-th record in place.
+
+        Args:
+            i (int): the index of the record.
+            c (bitstring.BitArray): a ciphertext of the record width.
+        """
+        # Check if the index is in range and the ciphertext has the record width
+        if not 0 <= i < self.count:
+            raise IndexError('Record index out of range')
+        assert len(c) == self.width, 'Invalid record length'
+        # Seek to the record and overwrite its bytes
+        self.f.seek(8 + i * self.size)
+        self.f.write(c.tobytes())
+
+    def __iter__(self):
+        """
+        Iterate over the records sequentially.
+
+        Yields:
+            bitstring.BitArray: the ciphertext of each record.
+        """
+        for i in range(self.count):
+            yield self[i]
+
+    def append(self, c):
+        """
+        Append a record to the end of the file.
+
+        Args:
+            c (bitstring.BitArray): a ciphertext of the record width.
+        """
+        # Check if the ciphertext has the record width
+        assert len(c) == self.width, 'Invalid record length'
+        # Seek to the end of the file and write the ciphertext bytes
+        self.f.seek(0, os.SEEK_END)
+        self.f.write(c.tobytes())
+        self.count += 1
+
+    def flush(self):
+        """
+        Flush the written records to disk.
+        """
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        """
+        Close the record file.
+        """
+        self.f.close()
+
+class IndexFile:
+    """
+    A class to store the encrypted index as a file of keyword and ciphertext lines sorted by keyword.
+
+    The keyword and byte offset of every interval-th line are kept in memory as a sparse index, so a lookup
+    seeks to the last sampled keyword before it and scans at most one interval of lines besides its own.
+    """
+
+    def __init__(self, path, mode='r', interval=INDEX_SPARSE_INTERVAL):
+        """
+        Initialize the index file.
+
+        Args:
+            path (str): the file path of the index.
+            mode (str): 'w+' to write a new index, or 'r' or 'r+' to read an existing one.
+            interval (int): the number of lines between two keywords of the sparse index.
+        """
+        self.path = path
+        self.mode = mode
+        self.interval = interval
+        # Open the file in binary mode, so the byte offsets of the lines can be sought
+        self.f = open(path, mode + 'b')
+        # Build the sparse index of an existing file, or start an empty one
+        if mode.startswith('w'):
+            self.keys, self.offsets, self.count, self.last = [], [], 0, None
+        else:
+            self.load_offsets()
+
+    def line(self, w, c):
+        """
+        Format the line of a keyword and a ciphertext.
+
+        Args:
+            w (str): a keyword.
+            c (bitstring.BitArray): a ciphertext.
+
+        Returns:
+            bytes: the keyword, the bit length and the hex bytes of the ciphertext on one line.
+        """
+        return f'{w} {len(c)} {c.tobytes().hex()}\n'.encode()
+
+    def load_offsets(self):
+        """
+        Build the sparse index by scanning the keywords of the file.
+        """
+        self.keys, self.offsets, self.count, self.last = [], [], 0, None
+        offset = 0
+        self.f.seek(0)
+        for line in self.f:
+            w = line.split(b' ', 1)[0].decode()
+            # Keep the keyword and offset of every interval-th line
+            if self.count % self.interval == 0:
+                self.keys.append(w)
+                self.offsets.append(offset)
+            offset += len(line)
+            self.count += 1
+            self.last = w
+
+    def write(self, w, c):
+        """
+        Write the ciphertext of a keyword to the end of the index, in keyword order.
+
+        Args:
+            w (str): a keyword, not less than the last keyword written.
+            c (bitstring.BitArray): the ciphertext of a block of the posting list of the keyword.
+        """
+        # Check if the keywords are written in sorted order, which the lookups rely on
+        assert self.last is None or w >= self.last, 'Index keywords out of order'
+        # Seek to the end of the file, keeping the keyword and offset of every interval-th line
+        offset = self.f.seek(0, os.SEEK_END)
+        if self.count % self.interval == 0:
+            self.keys.append(w)
+            self.offsets.append(offset)
+        # Write the line of the keyword and the ciphertext
+        self.f.write(self.line(w, c))
+        self.count += 1
+        self.last = w
+
+    def __iter__(self):
+        """
+        Iterate over the entries of the index.
+
+        Yields:
+            tuple: the keyword and the ciphertext of each entry.
+        """
+        # Rewind to the start of the file and parse each line
+        self.f.seek(0)
+        for line in self.f:
+            yield self.parse(line)
+
+    def parse(self, line):
+        """
+        Parse the line of a keyword and a ciphertext.
+
+        Args:
+            line (bytes): a line of the index file.
+
+        Returns:
+            tuple: the keyword and the ciphertext of the line.
+        """
+        w, length, data = line.decode().split()
+        return w, bitstring.BitArray(bytes.fromhex(data))[:int(length)]
+
+    def scan(self):
+        """
+        Iterate over the entries of the index with a file handle of its own, so lookups can run meanwhile.
+
+        Yields:
+            tuple: the keyword and the ciphertext of each entry.
+        """
+        with open(self.path, 'rb') as f:
+            for line in f:
+                yield self.parse(line)
+
+    def get(self, w):
+        """
+        Get the ciphertexts stored for a keyword.
+
+        Args:
+            w (str): a keyword.
+
+        Returns:
+            list: the ciphertexts of the posting list of the keyword, in file order.
+        """
+        # Seek to the last sampled keyword less than w, or to the start of the file
+        i = bisect.bisect_left(self.keys, w)
+        self.f.seek(self.offsets[i - 1] if i else 0)
+        # Scan the lines until a keyword greater than w, decoding only the ciphertexts of w
+        cs = []
+        for line in self.f:
+            v, rest = line.split(b' ', 1)
+            v = v.decode()
+            if v > w:
+                break
+            if v == w:
+                length, data = rest.split()
+                cs.append(bitstring.BitArray(bytes.fromhex(data.decode()))[:int(length)])
+        return cs
+
+    def items(self):
+        """
+        Iterate over the entries of the index like a dictionary.
+
+        Returns:
+            iterator: the keyword and ciphertext pairs of the index.
+        """
+        return iter(self)
+
+    @property
+    def staged_path(self):
+        """
+        Get the file path of the staged content of the index, next to the index.
+
+        Returns:
+            str: the file path of the staged index.
+        """
+        return self.path + '.tmp'
+
+    def stage(self, entries):
+        """
+        Write new entries to the staged index, to be swapped in by commit.
+
+        Args:
+            entries (iterable): the keyword and ciphertext pairs of the new index, in keyword order.
+
+        Returns:
+            int: the number of entries staged.
+        """
+        count = 0
+        # Stream the entries to the staged file and flush it to disk
+        with open(self.staged_path, 'wb') as f:
+            for w, c in entries:
+                f.write(self.line(w, c))
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        return count
+
+    def commit(self):
+        """
+        Atomically replace the index with the staged index, unless an interrupted commit already did.
+        """
+        # Replace the index with the staged file if it is still there
+        if os.path.exists(self.staged_path):
+            os.replace(self.staged_path, self.path)
+        # Reopen the index and rebuild the sparse index
+        self.f.close()
+        self.f = open(self.path, 'r+b')
+        self.load_offsets()
+
+    def rewrite(self, entries):
+        """
+        Atomically replace the content of the index with new entries.
+
+        Args:
+            entries (iterable): the keyword and ciphertext pairs of the new index, in keyword order.
+        """
+        self.stage(entries)
+        self.commit()
+
+    def flush(self):
+        """
+        Flush the written entries to disk.
+        """
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        """
+        Close the index file.
+        """
+        self.f.close()
+
+def write_run(pairs, tmp_dir):
+    """
+    Write sorted (keyword, doc_id) pairs as a run to a temporary file.
+
+    Args:
+        pairs (iterable): the (keyword, doc_id) pairs in sorted order.
+        tmp_dir (str): the directory of the temporary run files.
+
+    Returns:
+        str: the file path of the run.
+    """
+    # Write each pair on one line of a new temporary file
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+    with os.fdopen(fd, 'w') as f:
+        for w, doc_id in pairs:
+            f.write(f'{w} {doc_id}\n')
+    # Return the path of the run
+    return path
+
+def spill_run(pairs, tmp_dir):
+    """
+    Sort a buffer of (keyword, doc_id) pairs and write it as a run to a temporary file.
+
+    Args:
+        pairs (list): a list of (keyword, doc_id) pairs.
+        tmp_dir (str): the directory of the temporary run files.
+
+    Returns:
+        str: the file path of the run.
+    """
+    # Sort the pairs by keyword and then by document id
+    pairs.sort()
+    # Write the sorted pairs as a run
+    path = write_run(pairs, tmp_dir)
+    # Log the message of run spilled with the number of pairs
+    logger.info(f'{len(pairs)} pairs spilled to {path}.')
+    # Return the path of the run
+    return path
+
+def read_run(path):
+    """
+    Read the (keyword, doc_id) pairs of a run sequentially.
+
+    Args:
+        path (str): the file path of the run.
+
+    Yields:
+        tuple: the keyword and the document id of each pair.
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            w, doc_id = line.split()
+            yield w, int(doc_id)
+
+def merge_runs(paths, tmp_dir, fan_in=MERGE_FAN_IN):
+    """
+    Merge sorted runs into posting lists with multi-pass k-way merges of at most fan_in runs each.
+
+    While there are more than fan_in runs, groups of fan_in runs are merged into longer runs, which replace
+    them in tmp_dir. The last pass merges the remaining runs and groups the pairs by keyword.
+
+    Args:
+        paths (list): the file paths of the sorted runs.
+        tmp_dir (str): the directory of the temporary run files.
+        fan_in (int): the maximum number of runs open at once.
+
+    Yields:
+        tuple: each keyword in sorted order and an iterator over its sorted document ids, which must be
+        consumed before advancing to the next keyword.
+    """
+    # Check if the fan-in allows the number of runs to shrink
+    if fan_in < 2:
+        raise ValueError(f'Invalid merge fan-in: {fan_in}')
+    # Merge groups of fan_in runs until at most fan_in runs remain
+    while len(paths) > fan_in:
+        merged = []
+        for i in range(0, len(paths), fan_in):
+            group = paths[i : i + fan_in]
+            merged.append(write_run(heapq.merge(*(read_run(path) for path in group)), tmp_dir))
+            for path in group:
+                os.remove(path)
+        # Log the message of merge pass with the number of runs before and after
+        logger.info(f'{len(paths)} runs merged into {len(merged)} runs.')
+        paths = merged
+    # Merge the remaining runs by keyword and document id and group the pairs by keyword
+    for w, group in itertools.groupby(heapq.merge(*(read_run(path) for path in paths)), key=lambda p: p[0]):
+        yield w, (doc_id for _, doc_id in group)
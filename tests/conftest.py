@@ -0,0 +1,17 @@
+import os
+import sys
+
+# Make the top-level modules of the repository importable from the tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture
+def sk():
+    # A fixed secret key of two Mersenne primes, so the tests do not search for random primes
+    return {'p': 2 ** 61 - 1, 'q': 2 ** 89 - 1}
+
+@pytest.fixture
+def new_sk():
+    # Another fixed secret key, whose q has the same bit length so the ciphertexts keep their width
+    return {'p': 2 ** 31 - 1, 'q': 2 ** 89 - 1}
@@ -0,0 +1,43 @@
+import random
+import bitstring
+import pytest
+
+from encryption import Encryption
+
+def random_vector(rng, n):
+    return bitstring.BitArray([rng.random() < 0.3 for _ in range(n)])
+
+def test_decrypt_recovers_encrypted_vector(sk):
+    rng = random.Random(0)
+    enc = Encryption(sk, 125)
+    for _ in range(5):
+        x = random_vector(rng, enc.n)
+        c = enc.encrypt(x)
+        assert len(c) == enc.length == enc.m * enc.n + 8 * enc.l
+        assert enc.decrypt(c) == x
+
+def test_ip_of_real_ciphertexts(sk):
+    enc = Encryption(sk, 16)
+    c1 = enc.encrypt(bitstring.BitArray(uint=0b1010, length=16))
+    c2 = enc.encrypt(bitstring.BitArray(uint=0b0110, length=16))
+    assert 0 <= enc.ip(c1, c2) < enc.p
+
+def test_key_keeps_vector_width(sk):
+    enc = Encryption(sk, 40)
+    assert Encryption(enc.sk).n == 40
+    assert Encryption(enc.sk).fingerprint == enc.fingerprint
+    with pytest.raises(ValueError):
+        Encryption(enc.sk, 41)
+
+@pytest.mark.parametrize('n', [16, 61, 125])
+@pytest.mark.parametrize('workers', [None, 2])
+def test_decrypt_many_matches_decrypt(sk, n, workers):
+    rng = random.Random(n)
+    enc = Encryption(sk, n)
+    cs = [enc.encrypt(random_vector(rng, n)) for _ in range(7)]
+
+    x = enc.decrypt_many(cs, workers)
+
+    assert len(x) == len(cs) * n
+    for j, c in enumerate(cs):
+        assert x[j * n : (j + 1) * n] == enc.decrypt(c)
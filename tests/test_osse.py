@@ -0,0 +1,139 @@
+import os
+import pytest
+
+from encryption import Encryption
+from rotation import KeyRotation
+from osse import OSSE, load_resume_key
+
+DOCS = [
+    ['apple', 'banana', 'cherry'],
+    ['apple', 'banana'],
+    ['banana', 'cherry', 'date'],
+    ['apple', 'date'],
+    ['cherry'],
+    ['apple', 'banana', 'cherry', 'date'],
+]
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    # Run in a temporary directory with the database and the permutation key files the scheme expects
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    for path in ('data/pk.txt', 'data/ik.txt'):
+        with open(path, 'w') as f:
+            f.write('0')
+    with open('data/db.txt', 'w') as f:
+        f.write('\n'.join(' '.join(doc) for doc in DOCS))
+    return 'data/db.txt'
+
+def test_buckets_set_vector_width(db_path, sk):
+    osse = OSSE(db_path, buckets=125, sk=sk)
+    assert osse.n == osse.enc.n == 125
+    assert OSSE(db_path, sk=sk).n == 4
+    assert OSSE(db_path, stream=True, sk=sk).n == 256
+
+def test_keyword_to_buckets(db_path, sk):
+    osse = OSSE(db_path, buckets=64, hashes=3, sk=sk)
+    buckets = osse.db.keyword_to_buckets('apple')
+    assert len(buckets) == 3
+    assert all(0 <= b < 64 for b in buckets)
+    # The buckets only depend on the keyword, so queries and documents hash alike across instances
+    assert OSSE(db_path, buckets=64, hashes=3, sk=sk).db.keyword_to_buckets('apple') == buckets
+    assert osse.db.keyword_to_buckets('banana') != buckets
+
+def test_hashed_vectors(db_path, sk):
+    osse = OSSE(db_path, buckets=64, sk=sk)
+    x = osse.db.doc_to_vector(DOCS[0])
+    assert len(x) == 64
+    assert set(x.findall('0b1')) == {b for w in DOCS[0] for b in osse.db.keyword_to_buckets(w)}
+    # The vector of a query is covered by the vectors of the documents containing it
+    q = osse.db.query_to_vector(['apple', 'cherry'])
+    assert q & x == q
+
+def test_verify_filters_candidates(db_path, sk):
+    # 8 buckets hold 2 ids of 3 bits per block, so the posting lists span several blocks
+    osse = OSSE(db_path, buckets=8, sk=sk)
+    edb, eidx = osse.setup()
+    assert len(eidx['apple']) == 2
+    assert osse.postings(eidx, 'apple', 3) == {0, 1, 3, 5}
+
+    pk = [3, 0, 5, 1, 4, 2]
+    # Documents 0 and 5 contain apple and banana, documents 2 and 3 are false positives
+    res = [pk[doc_id] for doc_id in (0, 2, 3, 5)]
+    verified = osse.verify(eidx, ['apple', 'banana'], res, pk, len(edb))
+
+    assert verified == [pk[0], pk[5]]
+    # 2 false positives over the 4 documents not matching the query
+    assert osse.fp_rate == 0.5
+
+def test_materialize_decrypts_results_in_order(db_path, sk):
+    osse = OSSE(db_path, buckets=32, sk=sk)
+    edb, eidx = osse.setup()
+    pk = [3, 0, 5, 1, 4, 2]
+    res = [pk[4], pk[1]]
+
+    x = osse.materialize(edb, res, pk)
+
+    assert x == osse.db.doc_to_vector(DOCS[4]) + osse.db.doc_to_vector(DOCS[1])
+
+def test_setup_external_over_several_runs_and_merge_passes(db_path, sk, caplog):
+    osse = OSSE(db_path, buckets=8, stream=True, sk=sk)
+    # A budget of 1 byte spills every pair as its own run, which a fan-in of 2 merges over several passes
+    with caplog.at_level('INFO', logger='OSSE'):
+        edb, eidx = osse.setup_external('data/edb.bin', 'data/eidx.txt', memory_budget=1, fan_in=2)
+    assert sum('runs merged into' in r.getMessage() for r in caplog.records) > 2
+
+    assert len(edb) == len(DOCS)
+    for doc_id, doc in enumerate(DOCS):
+        assert osse.enc.decrypt(edb[doc_id]) == osse.db.doc_to_vector(doc)
+    # Every posting list spans blocks of 2 ids of 3 bits and decrypts to the documents of the keyword
+    for w in ('apple', 'banana', 'cherry', 'date', 'elderberry'):
+        assert osse.postings(eidx, w, 3) == {doc_id for doc_id, doc in enumerate(DOCS) if w in doc}
+    assert len(eidx.get('apple')) == 2
+
+def test_execute_checks_the_key_of_each_record(db_path, sk, new_sk):
+    osse = OSSE(db_path, buckets=8, sk=sk)
+    edb, eidx = osse.setup()
+    c = osse.query(['apple'])
+    # A key rotation starts after the query was generated and rotates the first record
+    new = Encryption(new_sk, 8)
+    rotation = KeyRotation(osse.enc, edb, eidx, workers=1, new=new, lock=osse.lock)
+    rotation.apply(0, [new.encrypt(osse.enc.decrypt(edb[0]))])
+    osse.rotation = rotation
+
+    assert osse.read(edb, 0)[0] is new
+    assert osse.read(edb, 1)[0] is osse.enc
+    with pytest.raises(ValueError):
+        osse.execute(edb, eidx, c)
+    # The re-issued query is encrypted under both keys
+    osse.execute(edb, eidx, osse.query(['apple']))
+
+def test_resume_rotation_with_the_checkpointed_key(db_path, sk, new_sk):
+    osse = OSSE(db_path, buckets=8, stream=True, sk=sk)
+    edb, eidx = osse.setup_external()
+    new = Encryption(new_sk, 8)
+    rotation = KeyRotation(osse.enc, edb, eidx, batch_size=2, workers=1, new=new)
+    apply = rotation.apply
+
+    def crash(start, cs):
+        if start == 2:
+            raise RuntimeError('crash')
+        apply(start, cs)
+
+    rotation.apply = crash
+    with pytest.raises(RuntimeError):
+        rotation.run()
+    edb.close()
+    eidx.close()
+
+    # The resumed run takes the vector width of the old key rather than the default number of buckets
+    osse = OSSE(db_path, stream=True, sk=load_resume_key())
+    assert osse.n == 8
+    edb, eidx, rotation = osse.resume_rotation(workers=1, background=False)
+
+    assert osse.enc.fingerprint == new.fingerprint
+    for doc_id, doc in enumerate(DOCS):
+        assert new.decrypt(edb[doc_id]) == osse.db.doc_to_vector(doc)
+    assert osse.postings(eidx, 'apple', 3) == {0, 1, 3, 5}
+    # Only the key file of the new key is left
+    assert os.listdir('data/keys') == [f'{new.fingerprint}.json']
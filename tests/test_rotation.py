@@ -0,0 +1,156 @@
+import os
+import shutil
+import stat
+import bitstring
+import pytest
+
+from encryption import Encryption, load_key
+from rotation import KeyRotation
+from storage import RecordFile, IndexFile
+
+class XorEncryption(Encryption):
+    """
+    A stand-in for the IPPE scheme that XORs 16-bit plaintexts with a mask derived from the key.
+    """
+
+    def encrypt(self, x):
+        return x ^ bitstring.BitArray(uint=self.p * 4099 % 65536, length=16)
+
+    decrypt = encrypt
+
+# The index entries of the store, more than a batch so the index is re-encrypted over several batches
+INDEX = [('a', 42), ('a', 43), ('b', 44), ('c', 45), ('d', 46), ('e', 47), ('e', 48)]
+
+def value(enc, c):
+    return enc.decrypt(c).uint
+
+def make_store(tmp_path, enc, count=10):
+    edb = RecordFile(str(tmp_path / 'edb.bin'), 16)
+    for i in range(count):
+        edb.append(enc.encrypt(bitstring.BitArray(uint=i, length=16)))
+    edb.flush()
+    eidx = IndexFile(str(tmp_path / 'eidx.txt'), 'w+')
+    for w, v in INDEX:
+        eidx.write(w, enc.encrypt(bitstring.BitArray(uint=v, length=16)))
+    eidx.flush()
+    return edb, eidx
+
+def make_rotation(tmp_path, enc, edb, eidx, new):
+    return KeyRotation(enc, edb, eidx, batch_size=3, workers=2,
+                       checkpoint_path=str(tmp_path / 'rotation.json'),
+                       journal_path=str(tmp_path / 'rotation.journal'),
+                       key_dir=str(tmp_path / 'keys'), new=new)
+
+@pytest.fixture
+def keys():
+    return XorEncryption({'p': 5, 'q': 7}), XorEncryption({'p': 6, 'q': 7})
+
+def test_rotation_reencrypts_records_and_index(tmp_path, keys):
+    old, new = keys
+    edb, eidx = make_store(tmp_path, old)
+
+    rotation = make_rotation(tmp_path, old, edb, eidx, new)
+    rotation.run()
+
+    assert [value(new, c) for c in edb] == list(range(10))
+    assert [(w, value(new, c)) for w, c in eidx.items()] == INDEX
+    assert rotation.metrics()['progress'] == 1.0
+    assert not os.path.exists(tmp_path / 'rotation.json')
+    assert not os.path.exists(tmp_path / 'eidx.txt.tmp')
+    # The new key is saved readable by the owner only and the retired key is deleted with the checkpoint
+    path = tmp_path / 'keys' / f'{new.fingerprint}.json'
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert load_key(new.fingerprint, str(tmp_path / 'keys')) == new.sk
+    assert not os.path.exists(tmp_path / 'keys' / f'{old.fingerprint}.json')
+
+def interrupt(tmp_path, old, new):
+    edb, eidx = make_store(tmp_path, old)
+    rotation = make_rotation(tmp_path, old, edb, eidx, new)
+    apply = rotation.apply
+
+    def crash(start, cs):
+        # Write part of the second batch, then fail before the checkpoint
+        if start == 3:
+            apply(start, cs[:1])
+            raise RuntimeError('crash')
+        apply(start, cs)
+
+    rotation.apply = crash
+    with pytest.raises(RuntimeError):
+        rotation.run()
+    edb.close()
+    eidx.close()
+
+def test_resume_replays_interrupted_batch(tmp_path, keys):
+    old, new = keys
+    interrupt(tmp_path, old, new)
+    assert os.path.exists(tmp_path / 'rotation.journal')
+
+    edb, eidx = RecordFile(str(tmp_path / 'edb.bin')), IndexFile(str(tmp_path / 'eidx.txt'), 'r+')
+    rotation = make_rotation(tmp_path, old, edb, eidx, new)
+    assert rotation.cursor == 6
+    assert not os.path.exists(tmp_path / 'rotation.journal')
+    rotation.run()
+
+    assert [value(new, c) for c in edb] == list(range(10))
+    assert [(w, value(new, c)) for w, c in eidx.items()] == INDEX
+
+@pytest.mark.parametrize('crash_after_replace', [False, True])
+def test_resume_completes_interrupted_index_swap(tmp_path, keys, crash_after_replace):
+    old, new = keys
+    edb, eidx = make_store(tmp_path, old)
+    rotation = make_rotation(tmp_path, old, edb, eidx, new)
+    commit = eidx.commit
+
+    def crash():
+        # Fail before the staged index replaces the index, or after it but before the checkpoint
+        if crash_after_replace:
+            commit()
+        raise RuntimeError('crash')
+
+    eidx.commit = crash
+    with pytest.raises(RuntimeError):
+        rotation.run()
+    edb.close()
+    eidx.close()
+    assert os.path.exists(tmp_path / 'eidx.txt.tmp') != crash_after_replace
+
+    # Resuming swaps the staged index in without re-encrypting it again
+    edb, eidx = RecordFile(str(tmp_path / 'edb.bin')), IndexFile(str(tmp_path / 'eidx.txt'), 'r+')
+    rotation = make_rotation(tmp_path, old, edb, eidx, new)
+    assert rotation.index_generation == 1
+    assert [(w, value(new, c)) for w, c in eidx.items()] == INDEX
+    rotation.run()
+
+    assert [value(new, c) for c in edb] == list(range(10))
+    assert [(w, value(new, c)) for w, c in eidx.items()] == INDEX
+
+def test_resume_refuses_checkpoint_of_other_key(tmp_path, keys):
+    old, new = keys
+    interrupt(tmp_path, old, new)
+
+    edb, eidx = RecordFile(str(tmp_path / 'edb.bin')), IndexFile(str(tmp_path / 'eidx.txt'), 'r+')
+    with pytest.raises(ValueError):
+        make_rotation(tmp_path, XorEncryption({'p': 7, 'q': 7}), edb, eidx, None)
+
+def test_resume_refuses_checkpoint_of_other_edb(tmp_path, keys):
+    old, new = keys
+    interrupt(tmp_path, old, new)
+    shutil.copy(tmp_path / 'edb.bin', tmp_path / 'other.bin')
+
+    edb, eidx = RecordFile(str(tmp_path / 'other.bin')), IndexFile(str(tmp_path / 'eidx.txt'), 'r+')
+    with pytest.raises(ValueError):
+        make_rotation(tmp_path, old, edb, eidx, new)
+
+def test_in_memory_rotation_is_not_checkpointed(tmp_path, keys):
+    old, new = keys
+    edb = [old.encrypt(bitstring.BitArray(uint=i, length=16)) for i in range(5)]
+    eidx = {'a': [old.encrypt(bitstring.BitArray(uint=42, length=16))]}
+
+    rotation = make_rotation(tmp_path, old, edb, eidx, new)
+    assert not os.path.exists(tmp_path / 'rotation.json')
+    rotation.run()
+
+    assert [value(new, c) for c in edb] == list(range(5))
+    assert [value(new, c) for c in eidx['a']] == [42]
+    assert not os.path.exists(tmp_path / 'keys')
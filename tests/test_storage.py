@@ -0,0 +1,85 @@
+import os
+import random
+import bitstring
+
+from utils import encode_postings, decode_postings, id_width, ids_per_block
+from storage import RecordFile, IndexFile, spill_run, merge_runs
+
+def test_record_file_reopen(tmp_path):
+    path = str(tmp_path / 'edb.bin')
+    edb = RecordFile(path, 13)
+    for i in range(5):
+        edb.append(bitstring.BitArray(uint=i, length=13))
+    edb[2] = bitstring.BitArray(uint=99, length=13)
+    edb.flush()
+    edb.close()
+
+    edb = RecordFile(path)
+    assert edb.width == 13
+    assert len(edb) == 5
+    assert [c.uint for c in edb] == [0, 1, 99, 3, 4]
+
+def test_index_file_get_and_rewrite(tmp_path):
+    path = str(tmp_path / 'eidx.txt')
+    eidx = IndexFile(path, 'w+')
+    eidx.write('a', bitstring.BitArray('0b101'))
+    eidx.write('a', bitstring.BitArray('0b1'))
+    eidx.write('b', bitstring.BitArray('0b0011'))
+    eidx.flush()
+    eidx.close()
+
+    eidx = IndexFile(path)
+    assert [c.bin for c in eidx.get('a')] == ['101', '1']
+    eidx.rewrite([('b', bitstring.BitArray('0b11'))])
+    assert [(w, c.bin) for w, c in eidx.items()] == [('b', '11')]
+    assert IndexFile(path).get('a') == []
+
+def test_merge_runs_over_several_passes(tmp_path):
+    rng = random.Random(0)
+    pairs = sorted({(f'w{rng.randrange(20)}', doc_id) for doc_id in range(200) for _ in range(3)})
+    expected = {}
+    for w, doc_id in pairs:
+        expected.setdefault(w, []).append(doc_id)
+    rng.shuffle(pairs)
+    runs = [spill_run(pairs[i : i + 37], str(tmp_path)) for i in range(0, len(pairs), 37)]
+    assert len(runs) > 4
+
+    merged = {w: list(doc_ids) for w, doc_ids in merge_runs(runs, str(tmp_path), fan_in=2)}
+
+    assert merged == expected
+    assert list(merged) == sorted(merged)
+    # The intermediate runs of the earlier passes are removed
+    assert len(os.listdir(tmp_path)) <= 2
+
+def test_postings_round_trip():
+    width = id_width(1000)
+    doc_ids = [0, 7, 511, 999, 3, 4, 5]
+    blocks = encode_postings(doc_ids, width, 32)
+    assert ids_per_block(width, 32) == 3
+    assert [len(x) for x in blocks] == [32, 32, 32]
+    assert [doc_id for x in blocks for doc_id in decode_postings(x, width)] == doc_ids
+
+def test_postings_fill_blocks_exactly():
+    # With 4 documents, 1023 is the largest id of the width and must not be mistaken for padding
+    width = id_width(1024)
+    blocks = encode_postings([1023, 0], width, 22)
+    assert len(blocks) == 1
+    assert decode_postings(blocks[0], width) == [1023, 0]
+
+def test_index_file_get_seeks_sparse_offsets(tmp_path):
+    path = str(tmp_path / 'eidx.txt')
+    rng = random.Random(1)
+    expected = {f'w{i:03d}': [bitstring.BitArray(uint=rng.randrange(256), length=8) for _ in range(rng.randrange(1, 6))]
+                for i in range(0, 100, 2)}
+    eidx = IndexFile(path, 'w+', interval=4)
+    for w in sorted(expected):
+        for c in expected[w]:
+            eidx.write(w, c)
+    eidx.flush()
+    assert len(eidx.keys) < len(expected)
+
+    # Look up every keyword, the missing ones between, before and after them, before and after reopening
+    for index in (eidx, IndexFile(path, interval=4)):
+        for i in range(-1, 101):
+            w = f'w{i:03d}'
+            assert index.get(w) == expected.get(w, [])
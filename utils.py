@@ -1,5 +1,6 @@
 import time
 import math
+import random
 import bitstring
 
 class Timer:
@@ -115,3 +116,87 @@ def int_to_bitarray(x, length=None):
         length = math.ceil(math.log2(x + 1))
     # Return the bit array representation of x with the given length
     return bitstring.BitArray(uint=x, length=length)
+
+def id_width(count):
+    """
+    Get the fixed bit width of the document ids of a database.
+
+    Args:
+    count (int): the number of documents.
+
+    Returns:
+    int: the number of bits needed to encode any document id in [0, count) and the all-ones padding id. 
+    """
+    # Return the bit length of the number of documents, so the all-ones id is never a document id
+    return max(1, count.bit_length())
+
+def ids_per_block(width, n):
+    """
+    Get the number of fixed-width document ids packed into an n-bit block.
+
+    Args:
+    width (int): the bit width of each document id.
+    n (int): the bit length of the blocks.
+
+    Returns:
+    int: the number of document ids per block. 
+    """
+    # Check if a block holds at least one document id
+    if width > n:
+        raise ValueError(f'Blocks of {n} bits cannot hold document ids of {width} bits')
+    # Return the number of whole ids fitting in a block
+    return n // width
+
+def encode_block(doc_ids, width, n):
+    """
+    Encode at most n // width document ids as an n-bit block, filling the free slots with the all-ones padding id.
+
+    Args:
+    doc_ids (list): a list of document ids.
+    width (int): the bit width of each document id.
+    n (int): the bit length of the block.
+
+    Returns:
+    bitstring.BitArray: a bit array of length n. 
+    """
+    # Get the number of slots of the block and check if the document ids fit
+    slots = ids_per_block(width, n)
+    assert len(doc_ids) <= slots, 'Too many document ids for one block'
+    # Shift the document ids and the padding ids into an integer, leaving the bits after the last slot zero
+    x = 0
+    for doc_id in list(doc_ids) + [(1 << width) - 1] * (slots - len(doc_ids)):
+        x = (x << width) | doc_id
+    # Return the n-bit bit array of the integer
+    return int_to_bitarray(x << (n - slots * width), n)
+
+def encode_postings(doc_ids, width, n):
+    """
+    Encode a posting list as n-bit blocks of fixed-width document ids.
+
+    Args:
+    doc_ids (list): a list of document ids.
+    width (int): the bit width of each document id.
+    n (int): the bit length of the blocks.
+
+    Returns:
+    list: a list of bit arrays of length n. 
+    """
+    # Split the posting list into chunks of one block each and encode every chunk
+    slots = ids_per_block(width, n)
+    return [encode_block(doc_ids[i : i + slots], width, n) for i in range(0, len(doc_ids), slots)]
+
+def decode_postings(x, width):
+    """
+    Decode a block of fixed-width document ids into a posting list, skipping the padding.
+
+    Args:
+    x (bitstring.BitArray): a block of fixed-width document ids.
+    width (int): the bit width of each document id.
+
+    Returns:
+    list: a list of document ids. 
+    """
+    # Split the block into slots of width bits, ignoring the bits after the last slot
+    ids = [x[i : i + width].uint for i in range(0, len(x) // width * width, width)]
+    # Return the ids of the slots which are not padding
+    return [doc_id for doc_id in ids if doc_id != (1 << width) - 1]